@@ -3,13 +3,18 @@
 """ AWS flow logs custom analyzer """
 
 import csv
+import io
+import logging
+import math
+import mmap
+import os
 import socket
-import threading
+import stat
 
 from abc import ABC, abstractmethod
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
-from itertools import islice
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+from operator import add
 
 ## Constants ##
 TAGMAP_PORT_IDX = 0
@@ -19,16 +24,36 @@ TAGMAP_TAG_IDX = 2
 IPMF_PORT_IDX = 0
 IPMF_PROTO_IDX = 1
 
-CHUNK_SIZE = 1000  # lines
+CHUNK_SIZE = 1 << 20  # bytes, rounded up to whole lines
+CSV_BUFFER_SIZE = 1 << 20  # bytes
+
+UNTAGGED = "Untagged"
 
 TAG_COUNT_FH = "\nTag Counts:\nTag,Count\n"
 COMB_COUNT_FH = "\nPort/Protocol Combination Counts:\nPort,Protocol,Count\n"
 
-V2_FIELDS_COUNT = 14
 V2_DST_PORT_IDX = 6
 V2_PROTO_NUM_IDX = 7
+# only the fields up to the protocol number are split out of a log line
+V2_MAX_SPLIT = V2_PROTO_NUM_IDX + 1
+
+# (port, protocol number) combinations are packed into a single int key as
+# port << 8 | protocol number, IP protocol numbers being 8 bit
+KEY_PROTO_BITS = 8
+KEY_PROTO_MASK = (1 << KEY_PROTO_BITS) - 1
+
+
+def _socket_proto_table():
+    # protocol names by protocol number, None for unknown numbers
+    prefix = "IPPROTO_"
+    table = [None] * (KEY_PROTO_MASK + 1)
+    for name, num in vars(socket).items():
+        if name.startswith(prefix) and 0 <= num <= KEY_PROTO_MASK:
+            table[num] = name[len(prefix):].lower()
+    return tuple(table)
 
-DEBUG = True
+
+SOCKET_PROTO_TABLE = _socket_proto_table()
 
 
 ## Exceptions ##
@@ -45,18 +70,90 @@ class ProtoMappingsException(Exception):
 
 
 ## Helper functions ##
-def read_csv_file(fname):
-    """ Helper function to read CSV file """
-    buff = []
+def iter_csv_file(fname):
+    """ Helper function to iterate over the rows of a CSV file """
     try:
-        with open(fname, mode='r') as file_handle:
-            csv_file = csv.reader(file_handle)
-            for line in csv_file:
-                buff.append(line)
+        with open(fname, mode='r', buffering=CSV_BUFFER_SIZE,
+                  newline='') as file_handle:
+            yield from csv.reader(file_handle)
     except IOError:
-        pass
+        return
+
+
+def read_csv_file(fname):
+    """ Helper function to read CSV file """
+    return list(iter_csv_file(fname))
+
+
+def split_file_chunks(handle, size):
+    """ Helper function to split a file into chunks of whole lines.
+
+        Returns the most chunks there can be, None when that is not known
+        up front, and an iterator over the chunks.
+    """
+    file_stat = os.fstat(handle.fileno())
+    if not stat.S_ISREG(file_stat.st_mode):
+        # pipes and other streams can neither be memory mapped nor sized
+        return None, iter_stream_chunks(handle, size)
+    if not file_stat.st_size:
+        return 0, iter(())  # empty files can not be memory mapped
+
+    # chunks are cut at the first line end after every size bytes, so
+    # there are at most this many
+    return (math.ceil(file_stat.st_size / size),
+            iter_mapped_chunks(handle, size))
+
+
+def iter_mapped_chunks(handle, size):
+    """ Helper function to split a regular file into chunks of whole lines """
+    with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        start = 0
+        while start < len(mapped):
+            end = mapped.find(b"\n", start + size)
+            end = len(mapped) if end < 0 else end + 1
+            yield mapped[start:end]
+            start = end
+
+
+def iter_stream_chunks(handle, size):
+    """ Helper function to split a stream into chunks of whole lines """
+    rest = b""
+    while True:
+        block = handle.read(size)
+        if not block:
+            break
+        block = rest + block
+        end = block.rfind(b"\n") + 1
+        if end:
+            yield block[:end]
+        rest = block[end:]
+    if rest:
+        yield rest
+
+
+# parser object of a worker process, see _init_worker()
+_worker_parser = None
+
+
+def _init_worker(parser):
+    """ Helper function to hand the parser object to a worker process """
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _analyze_chunk(chunk):
+    """ Helper function to analyze a chunk of logs in a worker process """
+    return _worker_parser._analyze_flow_logs(chunk)
+
 
-    return buff
+def pack_key(port, proto_num):
+    """ Helper function to pack a port, protocol number pair into a key """
+    return port << KEY_PROTO_BITS | proto_num
+
+
+def unpack_key(key):
+    """ Helper function to unpack a key into a port, protocol number pair """
+    return key >> KEY_PROTO_BITS, key & KEY_PROTO_MASK
 
 
 class TagMappings:
@@ -66,16 +163,14 @@ class TagMappings:
         self.fname = fname
 
     def process(self):
-        buff = []
+        rows = iter_csv_file(self.fname)
+        next(rows, None)  # skip the dstport,protocol,tag header
         try:
-            for line in read_csv_file(self.fname):
-                if line[TAGMAP_PORT_IDX] == "dstport":
-                    continue
-                buff.append((
-                    int(line[TAGMAP_PORT_IDX]),
-                    line[TAGMAP_PROTO_IDX],
-                    line[TAGMAP_TAG_IDX],
-                ))
+            buff = [(
+                int(line[TAGMAP_PORT_IDX]),
+                line[TAGMAP_PROTO_IDX],
+                line[TAGMAP_TAG_IDX],
+            ) for line in rows]
         except (IndexError, ValueError) as error:
             raise TagMappingsException(
                 "Error reading mappings file -{}".format(str(error)))
@@ -130,15 +225,16 @@ class GenericFlowLogParser(ABC):
 
         # data structures to hold processed info
         self.tag_map = {}
-        self.table = {}
+        self.tags = [UNTAGGED]
+        self.table = [None] * (KEY_PROTO_MASK + 1)
+        self.proto_fields = {}
         self.mappings = []
 
-        # result dicts
-        self.tag_count = defaultdict(int)
-        self.combinations_count = defaultdict(int)
-
-        # lock for results dicts updates
-        self.counts_lock = threading.Lock()
+        # results, reduced from the per chunk results of the workers, with
+        # the tag counts kept by tag id until all chunks are done
+        self.tag_count = Counter()
+        self.combinations_count = Counter()
+        self.errors = 0
 
     def log(self, msg):
         # info only for now
@@ -157,75 +253,152 @@ class GenericFlowLogParser(ABC):
         except TagMappingsException as error:
             raise FlowLogParserException(str(error))
 
-        self.log("Generating tag maps ..")
-        for entry in buff:
-            self.tag_map[(entry[0], entry[1])] = entry[2]
+        self.mappings = buff
+        self._build_tag_map()
 
     def read_proto_mappings(self):
+        # protocol names are stored lower case, as used in the tag map keys
         self.log("Reading proto mappings file..")
         if self.proto_map_file:
             proto_mappings = ProtoMappings(self.proto_map_file)
+            table = [None] * (KEY_PROTO_MASK + 1)
             try:
                 for entry in proto_mappings.process():
-                    self.table[entry[0]] = entry[1]
+                    if 0 <= entry[0] <= KEY_PROTO_MASK:
+                        table[entry[0]] = entry[1]
             except ProtoMappingsException as error:
                 raise FlowLogParserException(str(error))
+            self.table = table
         else:
-            prefix = "IPPROTO_"
-            self.table = {
-                num: name[len(prefix):]
-                for name, num in vars(socket).items()
-                if name.startswith(prefix)
-            }
+            self.table = SOCKET_PROTO_TABLE
+
+        # Protocol number fields of the known protocols, as they appear in
+        # the logs, mapped to the protocol number
+        self.proto_fields = {
+            str(num).encode(): num
+            for num, name in enumerate(self.table)
+            if name is not None
+        }
+        self._build_tag_map()
+
+    def _build_tag_map(self):
+        # The tag map is keyed by packed (port, protocol number) keys, while
+        # the mappings file names the protocols. So it needs both files and
+        # is rebuilt by whichever of them is read last.
+        #
+        # The tags are numbered, id 0 being UNTAGGED, and the tag map holds
+        # tag ids. The workers count tags in a list indexed by tag id.
+        self.tags = [UNTAGGED] + sorted(
+            {entry[TAGMAP_TAG_IDX] for entry in self.mappings} - {UNTAGGED})
+        self.tag_map = {}
+        if not self.mappings or not any(self.table):
+            return
+
+        self.log("Generating tag maps ..")
+        proto_nums = defaultdict(list)
+        for num, name in enumerate(self.table):
+            if name is not None:
+                proto_nums[name].append(num)
+
+        tag_ids = {tag: tag_id for tag_id, tag in enumerate(self.tags)}
+        for port, proto_name, tag in self.mappings:
+            for num in proto_nums.get(proto_name, ()):
+                self.tag_map[pack_key(port, num)] = tag_ids[tag]
 
     @abstractmethod
-    def _analyze_flow_logs(self, lines):
-        pass
+    def _analyze_flow_logs(self, chunk):
+        """ Analyze a chunk of the logs, given as bytes of whole lines.
+
+            Runs in a worker process, so changes to the parser object are
+            lost.
+            Returns a (tag counts, combination counts, errors) tuple for the
+            chunk. The tag counts are a list indexed by tag id (see
+            self.tags) and the combination counts a Counter.
+        """
 
     def analyze_flow_logs(self):
         if not self.flowlogs:
             return
 
         # Implementation Note:
-        # I have used max_workers=1 to have just one additional thread other
-        # than the main thread. The reason for this is that Python Global
-        # Interpreter Lock would not allow true multi-threading of CPU
-        # intensive threads. The threading here just lets the python main
-        # thread read the next chunk of log lines while the thread is processing
-        # the previous chunk. Python 3.13 makes GIL optional, so increasing
-        # max_workers might result in enhanced performance there.
+        # The chunks are analyzed by a pool of worker processes, one per
+        # CPU but no more than there are chunks. A logs file of a single
+        # chunk is analyzed in the main process, as starting a pool costs
+        # more than the pool saves there. The Python Global Interpreter
+        # Lock would not allow worker threads to run the CPU intensive
+        # analysis in parallel, while each process has its own interpreter
+        # and lock. The parser object is handed to every worker once, when
+        # the pool starts. Every chunk is analyzed into its own private
+        # counters and the results are reduced in the main process, so the
+        # workers share no state.
+        #
+        # The logs file is memory mapped and cut into chunks at line
+        # boundaries, each chunk being a single bytes object. Flow log
+        # records are plain ASCII, so tokenizing the raw bytes skips the
+        # UTF-8 decode, and no per line objects are created until a worker
+        # splits its chunk.
 
         self.log("Starting flow logs analysis ..")
-        with open(
-                self.flowlogs,
-                mode='r') as handle, ThreadPoolExecutor(max_workers=1) as executor:
-            while True:
-                lines = list(islice(handle, CHUNK_SIZE))
-                if not len(lines):
-                    break
-                executor.submit(self._analyze_flow_logs, lines)
-
-        if DEBUG:
-            for key, value in self.tag_count.items():
-                print(key, value)
-            for key, value in self.combinations_count.items():
-                print(key[0], key[1], value)
+        tag_counts = [0] * len(self.tags)
+        with open(self.flowlogs, mode='rb') as handle:
+            max_chunks, chunks = split_file_chunks(handle, CHUNK_SIZE)
+            workers = os.cpu_count() or 1
+            if max_chunks is not None:
+                workers = min(workers, max_chunks)
+
+            for result in self._map_chunks(chunks, workers):
+                chunk_tag_counts, combinations_count, errors = result
+                tag_counts = list(map(add, tag_counts, chunk_tag_counts))
+                self.combinations_count.update(combinations_count)
+                self.errors += errors
+        self.tag_count.update({
+            tag: count
+            for tag, count in zip(self.tags, tag_counts)
+            if count
+        })
+        self.log("Total errors: {}".format(self.errors))
+
+        if self.logger and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(self._format_results())
 
         self._write_output_file()
 
+    def _map_chunks(self, chunks, workers):
+        # yields the analysis results of the chunks, in order
+        if workers <= 1:
+            yield from map(self._analyze_flow_logs, chunks)
+            return
+
+        with Pool(workers, _init_worker, (self,)) as pool:
+            yield from pool.imap(_analyze_chunk, chunks)
+
     def _write_output_file(self):
         if not self.outputfile:
             return
 
         self.log("Writing output file ..")
+        results = self._format_results()
         with open(self.outputfile, 'w') as handle:
-            handle.write(TAG_COUNT_FH)
-            for key, value in self.tag_count.items():
-                handle.write("{} {}\n".format(key, value))
+            handle.write(results)
 
-            handle.write(COMB_COUNT_FH)
-            for key, value in self.combinations_count.items():
-                handle.write("{} {} {}\n".format(key[0], key[1], value))
+    def _format_results(self):
+        # the results are joined into a single string, written in one go
+        parts = [TAG_COUNT_FH]
+        parts.extend("{} {}\n".format(key, value)
+                     for key, value in self.tag_count.items())
+
+        # Combinations are counted by protocol number but reported by
+        # protocol name. Numbers sharing a name, such as the unnamed ones
+        # in the IANA file, are merged into one line.
+        by_name = Counter()
+        for key, value in self.combinations_count.items():
+            port, proto_num = unpack_key(key)
+            by_name[(port, self.table[proto_num])] += value
+
+        parts.append(COMB_COUNT_FH)
+        parts.extend("{} {} {}\n".format(port, proto_name, value)
+                     for (port, proto_name), value in by_name.items())
+        return "".join(parts)
 
 
 class DefaultFlowLogsParser(GenericFlowLogParser):
@@ -245,66 +418,86 @@ class DefaultFlowLogsParser(GenericFlowLogParser):
                  logger=None):
         super().__init__(version, logs, mappings, output, proto_map_file,
                          logger)
-        self.errors = 0
 
-    def _analyze_flow_logs(self, lines):
+    def _analyze_flow_logs(self, chunk):
         self.log("Analyzing version {} logs ..".format(self.version))
 
         # Implementation Note:
-        # I have used a lock here, even though the max_workers is set to 1.
-        # This is for future compatibility.
-
-        with self.counts_lock:
-            for line in lines:
-                fields = line.strip().split()
-                if len(fields) < V2_FIELDS_COUNT:
-                    self.errors += 1
-                    continue
-
-                try:
-                    dstport = fields[V2_DST_PORT_IDX]
-                    protocol_name = self.table[int(fields[V2_PROTO_NUM_IDX])]
-
-                    # Implementation Note:
-                    # In Python one can use a set as a key in a dictionary. I
-                    # have made use of this facility to help map (port, protocol)
-                    # to the tag provided in the mapfile.
-                    #
-                    # In programming languages that do not support this, I would
-                    # implement binary serach tree based lookup where the tree
-                    # nodes contain a list of protocols that can be mapped to
-                    # that port and the associated tag. Thus processing using
-                    # this tree structure would require an O(log(n)) lookup
-                    # (vs O(1) here) to find the tag that a particular port
-                    # using binary search, protocol combination needs to be
-                    # mapped to.
-                    #
-                    # Following is a sample C structure for the same tree node:
-                    #
-                    # typedef struct treenode {
-                    #   unsigned short port_num;
-                    #   protocol_list_t *head;
-                    #   struct treenode *left, *right;
-                    # } treenode_t;
-                    #
-                    # typedef struct protocol_list {
-                    #   char *protocol_name;
-                    #   char *tag;
-                    #   struct protocol_list *next, *prev;
-                    # } protocol_list_t;
-                    #
-
-                    key = (int(dstport), protocol_name.lower())
-
-                    if key in self.tag_map.keys():
-                        self.tag_count[self.tag_map[key]] += 1
-                    else:
-                        self.tag_count['Untagged'] += 1
-
-                    self.combinations_count[key] += 1
-                except (ValueError, IndexError):
-                    self.errors += 1
-        self.log("Total errors: {}".format(self.errors))
+        # The chunk is first aggregated into per (port, protocol) counts. The
+        # keys are collected in a list and counted in one go by Counter, whose
+        # counting loop runs in C. The tag lookup is then done once per
+        # unique combination and weighted by its count, rather than once per
+        # line. Flow logs repeat a small set of combinations, so this moves
+        # most of the work out of the per line loop.
+
+        # bind the lookups used in the loop to locals, as attribute access
+        # is noticeably slower than a local name in the per line loop
+        tag_map = self.tag_map
+        proto_fields = self.proto_fields
+        keys = []
+        add_key = keys.append
+        errors = 0
+        # the lines are read lazily off the chunk rather than materialized
+        # as a list with chunk.splitlines()
+        for line in io.BytesIO(chunk):
+            fields = line.split(None, V2_MAX_SPLIT)
+            if len(fields) < V2_MAX_SPLIT:
+                errors += 1
+                continue
+
+            # one dict probe on the raw field replaces int(), the range check
+            # and the table lookup, and rejects unknown protocols
+            proto_num = proto_fields.get(fields[V2_PROTO_NUM_IDX])
+            if proto_num is None:
+                errors += 1
+                continue
+
+            try:
+                dstport = int(fields[V2_DST_PORT_IDX])
+            except ValueError:
+                errors += 1
+                continue
+
+            # Implementation Note:
+            # The (port, protocol number) pair is packed into a single
+            # int, port << 8 | protocol number, which is used as the key
+            # to map the combination to the tag provided in the mapfile.
+            # An int key is cheaper to build and hash than a tuple of a
+            # port and a protocol name string.
+            #
+            # In programming languages without a hash map, I would
+            # implement binary serach tree based lookup where the tree
+            # nodes contain a list of protocols that can be mapped to
+            # that port and the associated tag. Thus processing using
+            # this tree structure would require an O(log(n)) lookup
+            # (vs O(1) here) to find the tag that a particular port
+            # using binary search, protocol combination needs to be
+            # mapped to.
+            #
+            # Following is a sample C structure for the same tree node:
+            #
+            # typedef struct treenode {
+            #   unsigned short port_num;
+            #   protocol_list_t *head;
+            #   struct treenode *left, *right;
+            # } treenode_t;
+            #
+            # typedef struct protocol_list {
+            #   char *protocol_name;
+            #   char *tag;
+            #   struct protocol_list *next, *prev;
+            # } protocol_list_t;
+            #
+
+            add_key(dstport << KEY_PROTO_BITS | proto_num)
+
+        combinations = Counter(keys)
+
+        tag_counts = [0] * len(self.tags)
+        for key, count in combinations.items():
+            tag_counts[tag_map.get(key, 0)] += count
+
+        return tag_counts, combinations, errors
 
 
 class CustomFlowLogsParser(GenericFlowLogParser):
@@ -326,5 +519,5 @@ class CustomFlowLogsParser(GenericFlowLogParser):
         super().__init__(version, logs, mappings, output, proto_map_file,
                          logger)
 
-    def _analyze_flow_logs(self, lines):
-        pass
+    def _analyze_flow_logs(self, chunk):
+        return [0] * len(self.tags), Counter(), 0
@@ -1,22 +1,26 @@
 #!/usr/bin/env python3
 
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
 from code.flowlog_parser import *
 
 class TestFlowLogParser(unittest.TestCase):
     def test_negative_case(self):
         flp = DefaultFlowLogsParser(2, "dummy", "dummy", "dummy")
-        lines = ["abc", "def", "ghi"]
-        flp._analyze_flow_logs(lines)
-        self.assertTrue(flp.errors > 0)
-        self.assertEqual(len(flp.tag_count), 0)
-        self.assertEqual(len(flp.combinations_count), 0)
+        chunk = b"abc\ndef\nghi\n"
+        tag_count, combinations_count, errors = flp._analyze_flow_logs(chunk)
+        self.assertTrue(errors > 0)
+        self.assertEqual(sum(tag_count), 0)
+        self.assertEqual(len(combinations_count), 0)
 
     def test_positve_case(self):
         flp = DefaultFlowLogsParser(2, "dummy", "dummy", "dummy")
-        flp.table[6]="tcp"
-        flp.tag_map[(49153, "tcp")] = "sv_P1"
-        flp.tag_map[(49154, "tcp")] = "sv_P1"
+        flp.mappings = [(49153, "tcp", "sv_P1"), (49154, "tcp", "sv_P1")]
+        flp.read_proto_mappings()
         lines = [
             "2 123456789012 eni-0a1b2c3d 10.0.1.201 198.51.100.2 443 49153 6 25 20000 1620140761 1620140821 ACCEPT OK",
             "2 123456789012 eni-4d3c2b1a 192.168.1.100 203.0.113.101 23 49154 6 15 12000 1620140761 1620140821 REJECT OK",
@@ -24,11 +28,147 @@ class TestFlowLogParser(unittest.TestCase):
             "2 123456789012 eni-5e6f7g8h 192.168.1.101 198.51.100.3 25 49155 6 10 8000 1620140761 1620140821 ACCEPT OK",
         ]
 
-        flp._analyze_flow_logs(lines)
-        self.assertTrue(flp.errors > 0)
-        self.assertEqual(len(flp.tag_count), 2)
-        self.assertEqual(len(flp.combinations_count), 3)
-        self.assertEqual(flp.tag_count['Untagged'], 1)
+        tag_count, combinations_count, errors = flp._analyze_flow_logs(
+            "\n".join(lines).encode())
+        self.assertTrue(errors > 0)
+        self.assertEqual(flp.tags, ["Untagged", "sv_P1"])
+        self.assertEqual(tag_count, [1, 2])
+        self.assertEqual(len(combinations_count), 3)
+
+    def test_unknown_protocol(self):
+        flp = DefaultFlowLogsParser(2, "dummy", "dummy", "dummy")
+        flp.read_proto_mappings()
+        lines = [
+            "2 123456789012 eni-0a1b2c3d 10.0.1.201 198.51.100.2 49153 443 200 25 20000 1620140761 1620140821 ACCEPT OK",
+            "2 123456789012 eni-0a1b2c3d 10.0.1.201 198.51.100.2 49153 443 262 25 20000 1620140761 1620140821 ACCEPT OK",
+            "2 123456789012 eni-0a1b2c3d 10.0.1.201 198.51.100.2 49153 443 -1 25 20000 1620140761 1620140821 ACCEPT OK",
+        ]
+
+        tag_count, combinations_count, errors = flp._analyze_flow_logs(
+            "\n".join(lines).encode())
+        self.assertEqual(errors, 3)
+        self.assertEqual(len(combinations_count), 0)
+
+    def test_tag_map(self):
+        flp = DefaultFlowLogsParser(2, "dummy", "dummy", "dummy")
+        flp.mappings = [(443, "tcp", "sv_P2"), (68, "udp", "sv_P1"),
+                        (31, "foo", "sv_P3")]
+        flp.read_proto_mappings()
+        self.assertEqual(flp.tags, ["Untagged", "sv_P1", "sv_P2", "sv_P3"])
+        self.assertEqual(flp.tag_map, {
+            pack_key(443, 6): 2,
+            pack_key(68, 17): 1,
+        })
+        self.assertEqual(unpack_key(pack_key(65535, 255)), (65535, 255))
+
+    def test_tag_mappings(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "mappings.csv")
+            with open(fname, "w") as handle:
+                handle.write("dstport,protocol,tag\n25,tcp,sv_P1\n68,udp,sv_P2\n")
+            self.assertEqual(TagMappings(fname).process(),
+                             [(25, "tcp", "sv_P1"), (68, "udp", "sv_P2")])
+
+            with open(fname, "a") as handle:
+                handle.write("abc,udp,sv_P3\n")
+            with self.assertRaises(TagMappingsException):
+                TagMappings(fname).process()
+
+        self.assertEqual(TagMappings(fname).process(), [])
+
+    def test_reload_empty_mappings(self):
+        line = "2 123456789012 eni-0a1b2c3d 10.0.1.201 198.51.100.2 49153 443 6 25 20000 1620140761 1620140821 ACCEPT OK\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "mappings.csv")
+            with open(fname, "w") as handle:
+                handle.write("dstport,protocol,tag\n25,tcp,sv_P1\n443,tcp,sv_P2\n")
+            flp = DefaultFlowLogsParser(2, "dummy", fname, "dummy")
+            flp.read_proto_mappings()
+            flp.read_mappings_file()
+            self.assertEqual(len(flp.tag_map), 2)
+
+            open(fname, "w").close()
+            flp.read_mappings_file()
+            self.assertEqual(flp.tags, ["Untagged"])
+            self.assertEqual(flp.tag_map, {})
+
+            tag_count, combinations_count, errors = flp._analyze_flow_logs(
+                line.encode())
+            self.assertEqual(tag_count, [1])
+
+    def test_analyze_flow_logs(self):
+        line = "2 123456789012 eni-0a1b2c3d 10.0.1.201 198.51.100.2 49153 {} 6 25 20000 1620140761 1620140821 ACCEPT OK\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logs = os.path.join(tmpdir, "logs.txt")
+            output = os.path.join(tmpdir, "output.txt")
+            with open(logs, "w") as handle:
+                handle.write(line.format(443) * 5 + line.format(25) * 3 + "abc")
+
+            flp = DefaultFlowLogsParser(2, logs, None, output)
+            flp.mappings = [(443, "tcp", "sv_P2")]
+            flp.read_proto_mappings()
+            with mock.patch("code.flowlog_parser.CHUNK_SIZE", 200):
+                flp.analyze_flow_logs()
+
+            self.assertEqual(flp.errors, 1)
+            self.assertEqual(flp.tag_count, {"sv_P2": 5, "Untagged": 3})
+
+            # a single chunk is analyzed without a pool of workers
+            single = DefaultFlowLogsParser(2, logs, None, None)
+            single.read_proto_mappings()
+            with mock.patch("code.flowlog_parser.Pool") as pool:
+                single.analyze_flow_logs()
+            pool.assert_not_called()
+            self.assertEqual(single.combinations_count,
+                             flp.combinations_count)
+            self.assertEqual(flp.combinations_count,
+                             {pack_key(443, 6): 5, pack_key(25, 6): 3})
+            with open(output) as handle:
+                self.assertIn("443 tcp 5\n", handle.read())
+
+            open(logs, "w").close()
+            flp = DefaultFlowLogsParser(2, logs, None, None)
+            flp.analyze_flow_logs()
+            self.assertEqual(flp.errors, 0)
+            self.assertEqual(len(flp.combinations_count), 0)
+
+    def test_format_results_merges_protocol_names(self):
+        proto_map_file = os.path.join(os.path.dirname(__file__), "files",
+                                      "protocol-numbers-1.csv")
+        flp = DefaultFlowLogsParser(2, "dummy", "dummy", "dummy",
+                                    proto_map_file=proto_map_file)
+        flp.read_proto_mappings()
+        flp.combinations_count.update({
+            pack_key(80, 61): 2,
+            pack_key(80, 63): 3,
+        })
+        self.assertIn("\n80  5\n", flp._format_results())
+
+    @unittest.skipUnless(hasattr(os, "mkfifo"), "requires named pipes")
+    def test_analyze_flow_logs_pipe(self):
+        line = "2 123456789012 eni-0a1b2c3d 10.0.1.201 198.51.100.2 49153 443 6 25 20000 1620140761 1620140821 ACCEPT OK\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logs = os.path.join(tmpdir, "logs.fifo")
+            os.mkfifo(logs)
+            # The pipe is fed from a separate process, so the pool workers
+            # forked below can not inherit its write end and hold off EOF.
+            writer = subprocess.Popen([
+                sys.executable, "-c",
+                "import sys\n"
+                "with open(sys.argv[1], 'w') as handle:\n"
+                "    handle.write(sys.argv[2])\n",
+                logs, line * 3 + "abc",
+            ])
+
+            flp = DefaultFlowLogsParser(2, logs, None, None)
+            flp.read_proto_mappings()
+            with mock.patch("code.flowlog_parser.CHUNK_SIZE", 200), \
+                    mock.patch("os.cpu_count", return_value=2):
+                flp.analyze_flow_logs()
+            writer.wait()
+
+            self.assertEqual(flp.errors, 1)
+            self.assertEqual(flp.combinations_count, {pack_key(443, 6): 3})
 
 if __name__ == "__main__":
     unittest.main()